@@ -1,10 +1,18 @@
 import os
-import csv
+import sys
+import copy
 import time
+import queue
+import atexit
+import signal
 import logging
+import logging.handlers
+import orjson
 import requests
+from collections import deque
 from datetime import datetime, timezone
-from threading import Thread
+from enum import IntEnum
+from threading import Event, RLock, Thread
 import argparse
 
 from ibapi.client import EClient
@@ -15,6 +23,12 @@ from ibapi.order import Order
 
 
 
+class BotState(IntEnum):
+    INIT = 0            # waiting for open orders and positions
+    WAITING_BUY = 1     # flat, BUY stop order working
+    WAITING_SELL = 2    # holding shares, SELL stop order working
+
+
 class IBClient(EWrapper, EClient):
     def __init__(
         self,
@@ -30,6 +44,15 @@ class IBClient(EWrapper, EClient):
         EClient.__init__(self, wrapper=self)
 
         self.webhook_url = os.getenv("DISCORD_WEBHOOK_URL")
+        self._notif_q = queue.Queue()
+        self._notif_session = requests.Session()
+        self._notif_window = 0.2
+        self._notif_max_len = 2000      # Discord message length limit
+        self._notif_thread = None
+        if self.webhook_url:
+            self._notif_thread = Thread(target=self._notification_loop, daemon=True)
+            self._notif_thread.start()
+            atexit.register(self.close_notifications)
 
         # Connection parameters
         self.host = host
@@ -37,7 +60,7 @@ class IBClient(EWrapper, EClient):
         self.client_id = client_id
 
         # Trading parameters
-        self.stock_symbol = stock_symbol
+        self.stock_symbol = sys.intern(stock_symbol)
         self.exchange = 'SMART'
         self.currency = 'USD'
         self.upper_bound = upper
@@ -45,62 +68,138 @@ class IBClient(EWrapper, EClient):
         self.buy_qty = buy_qty
 
         # Runtime state
+        self._state_lock = RLock()
         self.held_qty = 0
-        self.in_position = False
+        self.state = BotState.INIT
         self.active_order = None
-        self.fill_tracker = {}         # order_id -> filled quantity
+        self._active_filled = 0        # filled quantity of active_order
         self.last_buy_price = None
         self.running_loss = 0.0
+        self._fmt_2f = "{:.2f}".format
 
         # IB bookkeeping
         self.next_order_id = None
+        self._next_id_ready = Event()
+        self._stop_event = Event()
         self.open_orders_loaded = False
         self.positions_loaded = False
-        self.logged_position = False
 
         # Prepare contract
         self.contract = self.create_contract(
             self.stock_symbol, self.exchange, self.currency
         )
 
+        # Prepare order templates, copied for each placement
+        self._buy_template = self.create_stop_order(
+            "BUY", self.buy_qty, self.upper_bound
+        )
+        self._sell_template = self.create_stop_order(
+            "SELL", self.buy_qty, self.lower_bound
+        )
+
         # Setup logging
         os.makedirs("logs", exist_ok=True)
+        # Computed once: the .log and .csv files of a run share this timestamp
         start_time_utc = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H-%M-%SZ")
         log_filename = f"logs/ibapp_log_{start_time_utc}.log"
         logging.Formatter.converter = time.gmtime
+        log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        file_handler = logging.FileHandler(log_filename)
+        file_handler.setFormatter(logging.Formatter(log_format))
+        # Batch file writes; flushed on WARNING and above or when full
+        self._log_buffer = logging.handlers.MemoryHandler(
+            capacity=512,
+            flushLevel=logging.WARNING,
+            target=file_handler
+        )
         logging.basicConfig(
             level=logging.INFO,
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+            format=log_format,
             handlers=[
-                logging.FileHandler(log_filename),
+                self._log_buffer,
                 logging.StreamHandler()
             ]
         )
         self.logger = logging.getLogger(__name__)
 
-        # CSV setup
+        # CSV setup: rows are encoded by log_trade_event and written in
+        # batches by a background flusher straight to the file descriptor.
+        # Fields never contain commas or quotes, so no csv quoting is needed.
         self.csv_file = f"logs/ibapp_log_{start_time_utc}.csv"
-        with open(self.csv_file, "w", newline="") as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow([
-                "timestamp", "event", "action", "price", "quantity", "running_loss", "note"
-            ])
+        self._csv_fd = os.open(
+            self.csv_file,
+            os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND
+            | getattr(os, "O_BINARY", 0),    # no \r\n translation on Windows
+            0o644
+        )
+        self._write_csv_bytes(
+            b"timestamp,event,action,price,quantity,running_loss,note\r\n"
+        )
+        self._csv_queue = deque()
+        self._csv_batch_size = max(1, int(os.getenv("CSV_BATCH_SIZE", "64")))
+        self._csv_flush_interval = 0.05
+        self._csv_stop = Event()
+        self._csv_thread = Thread(target=self._csv_flush_loop, daemon=True)
+        self._csv_thread.start()
+        atexit.register(self.close_csv_log)
 
         # Initial log
         self.logger.info("Trading Bot Configuration:")
-        self.logger.info(f"  Stock Symbol     : {self.stock_symbol}")
-        self.logger.info(f"  Upper Threshold  : {self.upper_bound}")
-        self.logger.info(f"  Lower Threshold  : {self.lower_bound}")
-        self.logger.info(f"  Buy Quantity     : {self.buy_qty}")
+        self.logger.info("  Stock Symbol     : %s", self.stock_symbol)
+        self.logger.info("  Upper Threshold  : %s", self.upper_bound)
+        self.logger.info("  Lower Threshold  : %s", self.lower_bound)
+        self.logger.info("  Buy Quantity     : %s", self.buy_qty)
 
     def send_notification(self, text: str):
         if not self.webhook_url:
             return
-        payload = {"content": text}
-        try:
-            requests.post(self.webhook_url, json=payload, timeout=2)
-        except Exception:
-            pass
+        self._notif_q.put_nowait(text)
+
+    def _notification_loop(self):
+        pending = None
+        stopping = False
+        while not stopping:
+            msg = pending if pending is not None else self._notif_q.get()
+            if msg is None:     # stop sentinel from close_notifications
+                return
+            batch = [msg]
+            pending = None
+            length = len(msg)
+            deadline = time.monotonic() + self._notif_window
+            # Coalesce whatever arrives within the window into one message
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    msg = self._notif_q.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if msg is None:
+                    stopping = True
+                    break
+                if length + 1 + len(msg) > self._notif_max_len:
+                    pending = msg
+                    break
+                batch.append(msg)
+                length += 1 + len(msg)
+            payload = {"content": "\n".join(batch)}
+            try:
+                self._notif_session.post(
+                    self.webhook_url,
+                    data=orjson.dumps(payload),
+                    headers={"Content-Type": "application/json"},
+                    timeout=2
+                )
+            except Exception:
+                pass
+
+    def close_notifications(self):
+        if self._notif_thread is None or not self._notif_thread.is_alive():
+            return
+        # Everything queued ahead of the sentinel is still sent
+        self._notif_q.put_nowait(None)
+        self._notif_thread.join(timeout=5)
 
     def create_contract(self, symbol, exchange, currency):
         contract = Contract()
@@ -110,71 +209,122 @@ class IBClient(EWrapper, EClient):
         contract.currency = currency
         return contract
 
+    def create_stop_order(self, action, qty, aux_price):
+        order = Order()
+        order.action = action
+        order.orderType = "STP"
+        order.totalQuantity = qty
+        order.auxPrice = aux_price
+        order.orderRef = "AutoBot"
+        return order
+
     def connect_and_run(self):
+        # Hand the GIL over more often so the IB reader thread isn't held
+        # up behind the CSV and notification worker threads
+        sys.setswitchinterval(0.0005)
         self.connect(self.host, self.port, self.client_id)
         thread = Thread(target=self.run, daemon=True)
         thread.start()
-        while self.next_order_id is None:
-            time.sleep(0.1)
+        if not self._next_id_ready.wait(timeout=10):
+            raise RuntimeError("IB did not deliver nextValidId")
         self.reqOpenOrders()
         self.reqPositions()
         self.reqTickByTickData(1, self.contract, "AllLast", 0, False)
 
-    def log_trade_event(self, event_type, action, price=None, qty=0, note="", loss=None):
-        now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    def log_trade_event(self, event_type, action, price, qty, note):
+        now_str = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        price_str = self._fmt_2f(price)
+        loss_str = self._fmt_2f(self.running_loss)
         safe_note = note.replace(",", ";")
-        with open(self.csv_file, "a", newline="") as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow([
-                now_str,
-                event_type,
-                action,
-                f"{price:.2f}" if price is not None else "",
-                qty,
-                f"{self.running_loss:.2f}",
-                safe_note
-            ])
-        msg = f"[{event_type}] {action} {qty}@{price:.2f} | running loss: {self.running_loss:.2f} | {safe_note}"
+        self._csv_queue.append(
+            f"{now_str},{event_type},{action},{price_str},{qty},{loss_str},{safe_note}\r\n"
+            .encode("ascii", "replace")
+        )
+        msg = f"[{event_type}] {action} {qty}@{price_str} | running loss: {loss_str} | {safe_note}"
         self.send_notification(msg)
 
-    def initialize_orders_if_ready(self):
-        if not (self.open_orders_loaded and self.positions_loaded):
+    def _write_csv_batch(self):
+        csv_queue = self._csv_queue
+        count = min(len(csv_queue), self._csv_batch_size)
+        if count:
+            popleft = csv_queue.popleft
+            self._write_csv_bytes(b"".join([popleft() for _ in range(count)]))
+        return count
+
+    def _write_csv_bytes(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._csv_fd, view):]
+
+    def _csv_flush_loop(self):
+        while not self._csv_stop.is_set():
+            deadline = time.monotonic() + self._csv_flush_interval
+            # Keep draining while full batches are waiting, otherwise sleep
+            # out the rest of the flush interval
+            count = self._write_csv_batch()
+            while count and count == self._csv_batch_size:
+                count = self._write_csv_batch()
+            self._csv_stop.wait(max(0.0, deadline - time.monotonic()))
+
+    def close_csv_log(self):
+        if self._csv_fd is None:
             return
-        self.logger.info("Initialization complete. Evaluating current position...")
-        self.logger.info(f"Detected {self.held_qty} shares of {self.stock_symbol} in account.")
-        if self.held_qty >= self.buy_qty:
-            self.in_position = True
-            self.logger.info("Position fully held. Placing SELL stop order.")
-            self.place_sell_order()
-        elif self.held_qty == 0:
-            self.in_position = False
-            self.logger.info("No position held. Placing BUY stop order.")
-            self.place_buy_order()
-        else:
-            self.in_position = True
-            self.logger.warning(
-                f"Partial position detected: {self.held_qty}/{self.buy_qty} shares.")
-            self.logger.info("Placing SELL stop order for remaining shares.")
-            self.place_sell_order(for_qty=self.held_qty)
+        self._csv_stop.set()
+        self._csv_thread.join()
+        while self._write_csv_batch():
+            pass
+        os.fsync(self._csv_fd)
+        os.close(self._csv_fd)
+        self._csv_fd = None
+
+    def initialize_orders_if_ready(self):
+        with self._state_lock:
+            if not (self.state == BotState.INIT
+                    and self.open_orders_loaded and self.positions_loaded):
+                return
+            self.logger.info("Initialization complete. Evaluating current position...")
+            self.logger.info(
+                "Detected %s shares of %s in account.", self.held_qty, self.stock_symbol)
+            if self.held_qty >= self.buy_qty:
+                self.state = BotState.WAITING_SELL
+                self.logger.info("Position fully held. Placing SELL stop order.")
+                self.place_sell_order()
+            elif self.held_qty == 0:
+                self.state = BotState.WAITING_BUY
+                self.logger.info("No position held. Placing BUY stop order.")
+                self.place_buy_order()
+            else:
+                self.state = BotState.WAITING_SELL
+                self.logger.warning(
+                    "Partial position detected: %s/%s shares.", self.held_qty, self.buy_qty)
+                self.logger.info("Placing SELL stop order for remaining shares.")
+                self.place_sell_order(for_qty=self.held_qty)
 
     # IB Callbacks
     def nextValidId(self, order_id: int):
         self.next_order_id = order_id
-        self.logger.info(f"Next valid order ID: {order_id}")
-        self.reqOpenOrders()
-        self.reqPositions()
+        self._next_id_ready.set()
+        self.logger.info("Next valid order ID: %s", order_id)
 
     def tickByTickAllLast(
         self, reqId, tickType, timestamp, price,
         size, tickAttribLast, exchange, specialConditions
     ):
-        self.logger.info(f"Tick: {price} at {timestamp}")
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        self.logger.debug("Tick: %s at %s", price, timestamp)
 
     def openOrder(self, order_id, contract, order, order_state):
-        if contract.symbol == self.stock_symbol and order.orderType == "STP":
+        symbol = contract.symbol
+        if ((symbol is self.stock_symbol or symbol == self.stock_symbol)
+                and order.orderType == "STP"):
             order.orderId = order_id
-            self.active_order = order
-            self.logger.info(f"Found open order: {order_id} Action: {order.action}")
+            with self._state_lock:
+                ao = self.active_order
+                if ao is None or ao.orderId != order_id:
+                    self._active_filled = 0
+                self.active_order = order
+            self.logger.info("Found open order: %s Action: %s", order_id, order.action)
 
     def openOrderEnd(self):
         self.open_orders_loaded = True
@@ -182,9 +332,10 @@ class IBClient(EWrapper, EClient):
         self.initialize_orders_if_ready()
 
     def position(self, account, contract, pos, avgCost):
-        if contract.symbol == self.stock_symbol:
+        symbol = contract.symbol
+        if symbol is self.stock_symbol or symbol == self.stock_symbol:
             self.held_qty = int(pos)
-            self.logger.info(f"Position callback: {self.held_qty} shares.")
+            self.logger.info("Position callback: %s shares.", self.held_qty)
 
     def positionEnd(self):
         self.positions_loaded = True
@@ -192,100 +343,113 @@ class IBClient(EWrapper, EClient):
         self.initialize_orders_if_ready()
 
     def error(self, req_id, error_code, error_string, misc=''):
-        self.logger.error(f"Error. ReqId: {req_id}, Code: {error_code}, Msg: {error_string}")
+        self.logger.error(
+            "Error. ReqId: %s, Code: %s, Msg: %s", req_id, error_code, error_string)
 
     def execDetails(self, req_id, contract, execution):
+        symbol = contract.symbol
+        if not (symbol is self.stock_symbol or symbol == self.stock_symbol):
+            return
+        ao = self.active_order
         order_id = execution.orderId
-        executed_price = execution.price
-        fill_qty = execution.shares
-        if self.active_order and self.active_order.orderId == order_id:
-            self.fill_tracker[order_id] = self.fill_tracker.get(order_id, 0) + fill_qty
-            filled_total = self.fill_tracker[order_id]
-            action = self.active_order.action
+        if ao is None or ao.orderId != order_id:
+            return
+        with self._state_lock:
+            # Re-check under the lock in case the order changed meanwhile
+            ao = self.active_order
+            if ao is None or ao.orderId != order_id:
+                return
+            executed_price = execution.price
+            fill_qty = execution.shares
+            action = ao.action
+            buy_qty = self.buy_qty
+            filled_total = self._active_filled + fill_qty
+            self._active_filled = filled_total
             if action == "BUY":
                 self.last_buy_price = executed_price
                 self.log_trade_event(
                     "Executed", action, price=executed_price,
                     qty=fill_qty,
-                    note=f"Partial BUY fill at {executed_price:.2f}; total filled: {filled_total}/{self.buy_qty}"
+                    note=f"Partial BUY fill at {executed_price:.2f}; total filled: {filled_total}/{buy_qty}"
                 )
             elif action == "SELL":
+                last_buy_price = self.last_buy_price
                 loss = (
-                    (self.last_buy_price - executed_price) * float(fill_qty)
-                    if self.last_buy_price is not None else 0.0
+                    (last_buy_price - executed_price) * float(fill_qty)
+                    if last_buy_price is not None else 0.0
                 )
-                self.running_loss += loss
+                running_loss = self.running_loss + loss
+                self.running_loss = running_loss
                 self.log_trade_event(
                     "Executed", action, price=executed_price,
                     qty=fill_qty,
-                    note=f"Partial SELL at {executed_price:.2f}; loss: {loss:.2f}; running: {self.running_loss:.2f}",
-                    loss=loss
+                    note=f"Partial SELL at {executed_price:.2f}; loss: {loss:.2f}; running: {running_loss:.2f}"
                 )
-            if filled_total >= self.buy_qty:
-                self.logger.info(f"Order {order_id} fully filled.")
+            if filled_total >= buy_qty:
+                self.logger.info("Order %s fully filled.", order_id)
                 if action == "BUY":
                     self.active_order = None
-                    self.in_position = True
+                    self.state = BotState.WAITING_SELL
                     self.place_sell_order()
                 elif action == "SELL":
                     self.active_order = None
-                    self.in_position = False
+                    self.state = BotState.WAITING_BUY
                     self.place_buy_order()
-                del self.fill_tracker[order_id]
 
     # Order placement
     def place_buy_order(self):
-        if self.active_order is None:
-            order = Order()
-            order.action = "BUY"
-            order.orderType = "STP"
-            order.totalQuantity = self.buy_qty
-            order.auxPrice = self.upper_bound
-            order.orderId = self.next_order_id
-            order.orderRef = "AutoBot"
-            self.next_order_id += 1
-            self.placeOrder(order.orderId, self.contract, order)
-            self.active_order = order
-            self.log_trade_event(
-                "Placed", "BUY",
-                price=order.auxPrice,
-                qty=order.totalQuantity,
-                note="Stop loss BUY order placed."
-            )
-            self.logger.info(
-                f"Placed BUY stop order (ID: {order.orderId}) at {order.auxPrice}"
-            )
+        with self._state_lock:
+            if self.active_order is None:
+                order = copy.copy(self._buy_template)
+                order.orderId = self.next_order_id
+                self.next_order_id += 1
+                self.placeOrder(order.orderId, self.contract, order)
+                self.active_order = order
+                self._active_filled = 0
+                self.log_trade_event(
+                    "Placed", "BUY",
+                    price=order.auxPrice,
+                    qty=order.totalQuantity,
+                    note="Stop loss BUY order placed."
+                )
+                self.logger.info(
+                    "Placed BUY stop order (ID: %s) at %s", order.orderId, order.auxPrice
+                )
 
     def place_sell_order(self, for_qty=None):
-        if self.active_order is None:
-            qty = for_qty if for_qty is not None else self.buy_qty
-            order = Order()
-            order.action = "SELL"
-            order.orderType = "STP"
-            order.totalQuantity = qty
-            order.auxPrice = self.lower_bound
-            order.orderId = self.next_order_id
-            order.orderRef = "AutoBot"
-            self.next_order_id += 1
-            self.placeOrder(order.orderId, self.contract, order)
-            self.active_order = order
-            self.log_trade_event(
-                "Placed", "SELL",
-                price=order.auxPrice,
-                qty=qty,
-                note="Stop loss SELL order placed."
-            )
-            self.logger.info(
-                f"Placed SELL stop order (ID: {order.orderId}) for {qty} shares at {order.auxPrice}"
-            )
+        with self._state_lock:
+            if self.active_order is None:
+                order = copy.copy(self._sell_template)
+                if for_qty is not None:
+                    order.totalQuantity = for_qty
+                qty = order.totalQuantity
+                order.orderId = self.next_order_id
+                self.next_order_id += 1
+                self.placeOrder(order.orderId, self.contract, order)
+                self.active_order = order
+                self._active_filled = 0
+                self.log_trade_event(
+                    "Placed", "SELL",
+                    price=order.auxPrice,
+                    qty=qty,
+                    note="Stop loss SELL order placed."
+                )
+                self.logger.info(
+                    "Placed SELL stop order (ID: %s) for %s shares at %s",
+                    order.orderId, qty, order.auxPrice
+                )
 
     def run_bot(self):
+        signal.signal(signal.SIGTERM, lambda *_: self._stop_event.set())
         try:
-            while True:
-                time.sleep(1)
+            self._stop_event.wait()
+            self.logger.info("Shutdown requested in run_bot. Exiting...")
         except KeyboardInterrupt:
             self.logger.info("KeyboardInterrupt caught in run_bot. Exiting...")
-            self.disconnect()
+        self.disconnect()
+        self.close_csv_log()
+        self.close_notifications()
+        self._log_buffer.flush()
 
 
 if __name__ == "__main__":